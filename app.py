@@ -1,14 +1,218 @@
-from flask import Flask, render_template_string, request
+from flask import Flask, Response, request, stream_with_context
 import difflib
+import html
 import re
+import textwrap
 import os
-import json
-from openai import OpenAI
+import asyncio
+import hashlib
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import httpx
+import orjson
+from rapidfuzz.distance import Indel
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import islice
+from openai import AsyncOpenAI, OpenAI, APIConnectionError, APIError, RateLimitError
 
 app = Flask(__name__)
+logger = logging.getLogger(__name__)
 
-# Initialize OpenAI API key
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# OpenAI model used for the case summaries
+MODEL_ID = "gpt-4o-mini"
+
+# Maximum number of OpenAI requests in flight at once for a single submission
+MAX_CONCURRENT_REQUESTS = 32
+
+# Seconds of silence on a streamed response before a keepalive is sent
+KEEPALIVE_INTERVAL = 5
+
+# Headers for streamed responses: no caching, and no nginx output buffering
+STREAM_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+# Web server processes sharing the OpenAI account (gunicorn.conf.py exports its worker count)
+WORKER_PROCESSES = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+
+# Account-wide OpenAI limits (override per deployment tier); each process throttles itself,
+# so it dispatches at its share of them
+MAX_REQUESTS_PER_MINUTE = max(1, int(os.getenv("OPENAI_MAX_RPM", "500")) // WORKER_PROCESSES)
+MAX_TOKENS_PER_MINUTE = max(1, int(os.getenv("OPENAI_MAX_TPM", "200000")) // WORKER_PROCESSES)
+
+# Attempts per case before giving up on rate-limit or connection errors
+MAX_ATTEMPTS = 5
+
+# Leaky-bucket throttle for requests and tokens per minute, shared by all submissions in this process
+class RateLimiter:
+    def __init__(self, max_requests_per_minute, max_tokens_per_minute):
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.available_request_capacity = max_requests_per_minute
+        self.available_token_capacity = max_tokens_per_minute
+        self.last_update_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update_time
+        self.last_update_time = now
+        self.available_request_capacity = min(
+            self.max_requests_per_minute,
+            self.available_request_capacity + elapsed * self.max_requests_per_minute / 60
+        )
+        self.available_token_capacity = min(
+            self.max_tokens_per_minute,
+            self.available_token_capacity + elapsed * self.max_tokens_per_minute / 60
+        )
+
+    async def acquire(self, estimated_tokens):
+        # A single request larger than the whole budget only has to wait for a full bucket
+        estimated_tokens = min(estimated_tokens, self.max_tokens_per_minute)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.available_request_capacity >= 1 and self.available_token_capacity >= estimated_tokens:
+                    self.available_request_capacity -= 1
+                    self.available_token_capacity -= estimated_tokens
+                    return
+                wait = max(
+                    (1 - self.available_request_capacity) * 60 / self.max_requests_per_minute,
+                    (estimated_tokens - self.available_token_capacity) * 60 / self.max_tokens_per_minute
+                )
+            await asyncio.sleep(max(wait, 0.01))
+
+rate_limiter = RateLimiter(MAX_REQUESTS_PER_MINUTE, MAX_TOKENS_PER_MINUTE)
+
+# Tracks brace depth across streamed chunks, ignoring braces inside JSON strings,
+# so a streamed completion can be cut off as soon as its top-level JSON object closes
+class JSONObjectTracker:
+    def __init__(self):
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escape = False
+
+    # Returns the offset just past the closing brace if it is in this chunk, otherwise -1
+    def feed(self, chunk):
+        for index, char in enumerate(chunk):
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == '\\':
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '{':
+                self.depth += 1
+                self.started = True
+            elif not self.started:
+                continue
+            elif char == '"':
+                self.in_string = True
+            elif char == '}':
+                self.depth -= 1
+                if self.depth == 0:
+                    return index + 1
+        return -1
+
+# Number of summaries kept in the in-memory LRU cache
+SUMMARY_CACHE_SIZE = 1024
+
+# Raw JSON summaries keyed by a hash of model, prompt and case text, most recently used last
+summary_cache = OrderedDict()
+summary_cache_lock = threading.Lock()
+
+def summary_cache_key(case_text, custom_prompt):
+    return hashlib.sha256(f"{MODEL_ID}\0{custom_prompt}\0{case_text}".encode()).hexdigest()
+
+# Summaries are also kept on disk, shared by every worker process and across restarts
+# (set SUMMARY_CACHE_PATH to an empty string to keep them in memory only)
+SUMMARY_CACHE_PATH = os.getenv("SUMMARY_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "summary_cache.sqlite3"))
+# Seconds an on-disk summary stays valid; the summaries are derived from patient reports,
+# so expired rows are deleted rather than just skipped
+SUMMARY_CACHE_TTL = 24 * 3600
+# Most summaries kept on disk; the oldest beyond this are deleted
+SUMMARY_CACHE_MAX_ROWS = 20000
+# Seconds to wait for another worker's lock: the cache is read and written on the summary event loop,
+# so a contended cache is skipped rather than allowed to stall every case in flight
+SUMMARY_CACHE_LOCK_TIMEOUT = 0.25
+
+# One SQLite connection per thread; summaries run on a fresh event-loop thread per submission
+summary_db_local = threading.local()
+
+# Open this thread's connection, creating the table and pruning expired and excess rows on the way
+def summary_db():
+    db = getattr(summary_db_local, "db", None)
+    if db is None:
+        db = sqlite3.connect(SUMMARY_CACHE_PATH, timeout=SUMMARY_CACHE_LOCK_TIMEOUT, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE IF NOT EXISTS summaries (key TEXT PRIMARY KEY, content TEXT NOT NULL, created REAL NOT NULL)")
+        db.execute("CREATE INDEX IF NOT EXISTS summaries_created ON summaries (created)")
+        summary_db_local.db = db
+        db.execute("DELETE FROM summaries WHERE created <= ?", (time.time() - SUMMARY_CACHE_TTL,))
+        db.execute(
+            "DELETE FROM summaries WHERE key IN (SELECT key FROM summaries ORDER BY created DESC LIMIT -1 OFFSET ?)",
+            (SUMMARY_CACHE_MAX_ROWS,)
+        )
+    return db
+
+def remember_summary(key, response_content):
+    with summary_cache_lock:
+        summary_cache[key] = response_content
+        summary_cache.move_to_end(key)
+        if len(summary_cache) > SUMMARY_CACHE_SIZE:
+            summary_cache.popitem(last=False)
+
+def get_cached_summary(key):
+    with summary_cache_lock:
+        response_content = summary_cache.get(key)
+        if response_content is not None:
+            summary_cache.move_to_end(key)
+            return response_content
+    if not SUMMARY_CACHE_PATH:
+        return None
+    try:
+        row = summary_db().execute(
+            "SELECT content FROM summaries WHERE key = ? AND created > ?", (key, time.time() - SUMMARY_CACHE_TTL)
+        ).fetchone()
+    except sqlite3.Error:
+        logger.warning("Summary cache read failed", exc_info=True)
+        return None
+    if row is None:
+        return None
+    remember_summary(key, row[0])
+    return row[0]
+
+def cache_summary(key, response_content):
+    remember_summary(key, response_content)
+    if not SUMMARY_CACHE_PATH:
+        return
+    try:
+        summary_db().execute(
+            "INSERT OR REPLACE INTO summaries (key, content, created) VALUES (?, ?, ?)", (key, response_content, time.time())
+        )
+    except sqlite3.Error:
+        logger.warning("Summary cache write failed", exc_info=True)
+
+# HTTP/2 lets concurrent OpenAI calls share one multiplexed connection instead of a TLS handshake each
+HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+HTTP_TIMEOUT = httpx.Timeout(60.0)
+
+# Synchronous client for Batch API file and job management
+client = OpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    http_client=httpx.Client(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+)
+
+# Build an async OpenAI client with a pooled HTTP/2 connection set for one batch of cases
+def create_async_client():
+    return AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        http_client=httpx.AsyncClient(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+    )
 
 # Default customized prompt
 DEFAULT_PROMPT = """Succinctly organize the changes made by the attending to the resident's radiology reports into: 
@@ -31,342 +235,532 @@ Respond in this JSON format, with no other additional text or pleasantries:
   "score": <score>
 }"""
 
+# Whitespace that costs prompt tokens without carrying meaning
+TRAILING_SPACE_RE = re.compile(r'[ \t]+(?=\r?\n|\Z)')
+INNER_SPACE_RE = re.compile(r'(?<=\S)[ \t]{2,}')
+BLANK_LINES_RE = re.compile(r'\n{3,}')
+
+# Trim trailing and repeated interior spaces, CRLFs and runs of blank lines from a prompt;
+# leading indentation (as in the JSON example) is kept
+def compact_prompt(prompt):
+    prompt = TRAILING_SPACE_RE.sub("", textwrap.dedent(prompt.replace("\r\n", "\n")))
+    return BLANK_LINES_RE.sub("\n\n", INNER_SPACE_RE.sub(" ", prompt)).strip()
+
+DEFAULT_PROMPT = compact_prompt(DEFAULT_PROMPT)
+
+# Prompt submitted with the form, compacted the same way as the default
+def get_custom_prompt():
+    return compact_prompt(request.form.get('custom_prompt', DEFAULT_PROMPT))
+
+# Regexes compiled once at import instead of on every request
+CASE_RE = re.compile(r'\bCase\s+(\d+)', re.IGNORECASE)
+REPORT_LABEL_RE = re.compile(r'\s*(Attending\s+Report\s*:|Resident\s+Report\s*:)\s*', re.IGNORECASE)
+PARAGRAPH_BREAK_RE = re.compile(r'\n{2,}|\n(?=\w)')
+SENTENCE_BREAK_RE = re.compile(r'(?<=[.!?])\s+')
+# Any whitespace run containing a line boundary (the same boundaries str.splitlines uses)
+LINE_BREAK_RE = re.compile(r'\s*[\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]\s*')
+
 # Normalize text: trim spaces but keep returns (newlines) intact
 def normalize_text(text):
-    return "\n".join([line.strip() for line in text.splitlines() if line.strip()])
+    return LINE_BREAK_RE.sub("\n", text.strip())
 
-# Remove "attending review" lines for comparison purposes
-def remove_attending_review_line(text):
-    excluded_lines = [
-        "As the attending physician, I have personally reviewed the images, interpreted and/or supervised the study or procedure, and agree with the wording of the above report.",
-        "As the Attending radiologist, I have personally reviewed the images, interpreted the study, and agree with the wording of the above report by Sterling M. Jones"
-    ]
-    return "\n".join([line for line in text.splitlines() if line.strip() not in excluded_lines])
+# Attending attestation lines, ignored when comparing reports (a set, so each line is one hash lookup)
+EXCLUDED_LINES = frozenset({
+    "As the attending physician, I have personally reviewed the images, interpreted and/or supervised the study or procedure, and agree with the wording of the above report.",
+    "As the Attending radiologist, I have personally reviewed the images, interpreted the study, and agree with the wording of the above report by Sterling M. Jones"
+})
 
-# Extract sections by headers ending with a colon
-def extract_sections(text):
-    pattern = r'(.*?:)(.*?)(?=(?:\n.*?:)|\Z)'
-    matches = re.findall(pattern, text, flags=re.DOTALL)
-    sections = [{'header': header.strip(), 'content': content.strip()} for header, content in matches]
-    return sections
+# Normalize the attending report and drop its "attending review" lines in one pass over the lines
+# Memoized: each report is cleaned for its change percentage and again when its diff is requested
+@lru_cache(maxsize=2048)
+def clean_attending(text):
+    return "\n".join(line for line in (raw.strip() for raw in text.splitlines()) if line and line not in EXCLUDED_LINES)
 
-# Calculate percentage change between two reports
-def calculate_change_percentage(resident_text, attending_text):
-    matcher = difflib.SequenceMatcher(None, resident_text.split(), attending_text.split())
-    return round((1 - matcher.ratio()) * 100, 2)
+# Calculate percentage change between two reports from their word lists
+# Indel similarity is 2 * LCS / total words: the exact form of what SequenceMatcher.ratio approximates, in native code
+def calculate_change_percentage(resident_words, attending_words):
+    # Unchanged reports (common for cases signed without edits) need no comparison at all
+    if resident_words == attending_words:
+        return 0.0
+    return round((1 - Indel.normalized_similarity(resident_words, attending_words)) * 100, 2)
 
 # Compare reports section by section
 def split_into_paragraphs(text):
     # Split the text into paragraphs based on double line breaks or single line breaks after punctuation
-    paragraphs = re.split(r'\n{2,}|\n(?=\w)', text)
+    paragraphs = PARAGRAPH_BREAK_RE.split(text)
     return [para.strip() for para in paragraphs if para.strip()]
 
+# SequenceMatcher for the report diff. autojunk is off: past 200 items it would treat common words
+# ("no", "the", "normal") as junk and skew the diff
+class ReportMatcher(difflib.SequenceMatcher):
+    def __init__(self, a, b):
+        super().__init__(None, a, b, autojunk=False)
+
+# Replaced paragraphs longer than this many characters are aligned by sentence before the word diff
+LONG_PARAGRAPH_CHARS = 2000
+
+# Minimum word similarity for two paragraphs of an uneven replaced run to be diffed against each other
+PARAGRAPH_PAIR_CUTOFF = 0.5
+
+# Split a normalized report into (paragraphs, words of each paragraph), once per report
+def tokenize_report(text):
+    # Escape the pasted text up front so report content can never inject markup into the diff;
+    # escaping maps each token one-to-one, so paragraphs, words and opcodes come out the same
+    paragraphs = split_into_paragraphs(html.escape(text, quote=False))
+    return paragraphs, [paragraph.split() for paragraph in paragraphs]
+
+# Memoized, so reopening a case or resubmitting the same block skips difflib
+@lru_cache(maxsize=512)
 def create_diff_by_section(resident_text, attending_text):
     # Normalize text for comparison
-    resident_text = normalize_text(resident_text)
-    attending_text = normalize_text(remove_attending_review_line(attending_text))
+    return diff_reports(tokenize_report(normalize_text(resident_text)), tokenize_report(clean_attending(attending_text)))
+
+# Combined diff HTML of two tokenized reports
+def diff_reports(resident, attending):
+    resident_paragraphs, resident_words = resident
+    attending_paragraphs, attending_words = attending
 
-    # Split text into paragraphs instead of sentences
-    resident_paragraphs = split_into_paragraphs(resident_text)
-    attending_paragraphs = split_into_paragraphs(attending_text)
+    # Unchanged reports are all one 'equal' run: emit the paragraphs without building a matcher
+    if resident_paragraphs == attending_paragraphs:
+        return "".join(paragraph + "<br><br>" for paragraph in resident_paragraphs)
 
-    diff_html = ""
+    # Collect fragments and join once at the end rather than regrowing one string per opcode
+    diff_parts = []
 
     # Use SequenceMatcher on the paragraph level first
-    matcher = difflib.SequenceMatcher(None, resident_paragraphs, attending_paragraphs)
+    matcher = ReportMatcher(resident_paragraphs, attending_paragraphs)
     for opcode, a1, a2, b1, b2 in matcher.get_opcodes():
         # Handle matched (equal) paragraphs
         if opcode == 'equal':
             for paragraph in resident_paragraphs[a1:a2]:
-                diff_html += paragraph + "<br><br>"
+                diff_parts.append(paragraph + "<br><br>")
 
         # Handle inserted paragraphs as a block
         elif opcode == 'insert':
             for paragraph in attending_paragraphs[b1:b2]:
-                diff_html += f'<div style="color:lightgreen;">[Inserted: {paragraph}]</div><br><br>'
+                diff_parts.append(f'<div class="ins">[Inserted: {paragraph}]</div><br><br>')
 
         # Handle deleted paragraphs as a block
         elif opcode == 'delete':
             for paragraph in resident_paragraphs[a1:a2]:
-                diff_html += f'<div style="color:#ff6b6b;text-decoration:line-through;">[Deleted: {paragraph}]</div><br><br>'
+                diff_parts.append(f'<div class="del">[Deleted: {paragraph}]</div><br><br>')
 
         # Handle paragraph replacements by word-by-word comparison within each paragraph
         elif opcode == 'replace':
-            res_paragraphs = resident_paragraphs[a1:a2]
-            att_paragraphs = attending_paragraphs[b1:b2]
-            for res_paragraph, att_paragraph in zip(res_paragraphs, att_paragraphs):
-                # Compare the words within the mismatched paragraphs
-                word_matcher = difflib.SequenceMatcher(None, res_paragraph.split(), att_paragraph.split())
-                for word_opcode, w_a1, w_a2, w_b1, w_b2 in word_matcher.get_opcodes():
-                    if word_opcode == 'equal':
-                        diff_html += " ".join(res_paragraph.split()[w_a1:w_a2]) + " "
-                    elif word_opcode == 'replace':
-                        diff_html += (
-                            '<span style="color:#ff6b6b;text-decoration:line-through;">' +
-                            " ".join(res_paragraph.split()[w_a1:w_a2]) +
-                            '</span> <span style="color:lightgreen;">' +
-                            " ".join(att_paragraph.split()[w_b1:w_b2]) +
-                            '</span> '
-                        )
-                    elif word_opcode == 'delete':
-                        diff_html += (
-                            '<span style="color:#ff6b6b;text-decoration:line-through;">' +
-                            " ".join(res_paragraph.split()[w_a1:w_a2]) +
-                            '</span> '
-                        )
-                    elif word_opcode == 'insert':
-                        diff_html += (
-                            '<span style="color:lightgreen;">' +
-                            " ".join(att_paragraph.split()[w_b1:w_b2]) +
-                            '</span> '
-                        )
-
-                diff_html += "<br><br>"  # Separate each replaced paragraph with line breaks
-
-    return diff_html
+            for i, j in pair_replaced_paragraphs(resident_words, attending_words, a1, a2, b1, b2):
+                if j is None:
+                    diff_parts.append(f'<div class="del">[Deleted: {resident_paragraphs[i]}]</div><br><br>')
+                elif i is None:
+                    diff_parts.append(f'<div class="ins">[Inserted: {attending_paragraphs[j]}]</div><br><br>')
+                else:
+                    # Compare the words within the mismatched paragraphs
+                    append_paragraph_diff(diff_parts, resident_paragraphs[i], attending_paragraphs[j], resident_words[i], attending_words[j])
+                    diff_parts.append("<br><br>")  # Separate each replaced paragraph with line breaks
+
+    return "".join(diff_parts)
+
+# Pair the paragraphs of a replaced run as (resident index, attending index), with None for a paragraph
+# that is only on one side. Equal-length runs pair in order; otherwise each resident paragraph is paired
+# with the most similar attending paragraph after the previous pair, so no paragraph is dropped and
+# difflib is never asked to word-diff unrelated text
+def pair_replaced_paragraphs(resident_words, attending_words, a1, a2, b1, b2):
+    if a2 - a1 == b2 - b1:
+        return list(zip(range(a1, a2), range(b1, b2)))
+    pairs = []
+    next_j = b1
+    for i in range(a1, a2):
+        best_j, best_score = None, PARAGRAPH_PAIR_CUTOFF
+        for j in range(next_j, b2):
+            score = Indel.normalized_similarity(resident_words[i], attending_words[j])
+            if score >= best_score:
+                best_j, best_score = j, score
+                if score == 1.0:
+                    break
+        if best_j is None:
+            pairs.append((i, None))
+            continue
+        pairs.extend((None, j) for j in range(next_j, best_j))
+        pairs.append((i, best_j))
+        next_j = best_j + 1
+    pairs.extend((None, j) for j in range(next_j, b2))
+    return pairs
+
+# Append the word-by-word diff of two word lists to diff_parts
+def append_word_diff(diff_parts, res_words, att_words):
+    word_matcher = ReportMatcher(res_words, att_words)
+    # Opcode ranges are never empty (equal/delete cover resident words, insert attending words,
+    # replace both), so every span has content; pieces go straight into the list with no
+    # intermediate concatenated strings
+    for word_opcode, w_a1, w_a2, w_b1, w_b2 in word_matcher.get_opcodes():
+        if word_opcode == 'equal':
+            diff_parts.extend((" ".join(res_words[w_a1:w_a2]), " "))
+        elif word_opcode == 'replace':
+            diff_parts.extend(('<span class="del">', " ".join(res_words[w_a1:w_a2]), '</span> <span class="ins">', " ".join(att_words[w_b1:w_b2]), '</span> '))
+        elif word_opcode == 'delete':
+            diff_parts.extend(('<span class="del">', " ".join(res_words[w_a1:w_a2]), '</span> '))
+        elif word_opcode == 'insert':
+            diff_parts.extend(('<span class="ins">', " ".join(att_words[w_b1:w_b2]), '</span> '))
+
+# Diff a replaced paragraph pair word by word. difflib is quadratic in the worst case, so long
+# paragraphs are matched sentence by sentence first and only the changed sentences are word-diffed
+def append_paragraph_diff(diff_parts, res_paragraph, att_paragraph, res_words, att_words):
+    # Paired paragraphs inside a replaced run can still be word-for-word identical; they are one 'equal' run
+    if res_words == att_words:
+        diff_parts.extend((" ".join(res_words), " "))
+        return
+    if max(len(res_paragraph), len(att_paragraph)) <= LONG_PARAGRAPH_CHARS:
+        append_word_diff(diff_parts, res_words, att_words)
+        return
+    res_sentences = SENTENCE_BREAK_RE.split(res_paragraph)
+    att_sentences = SENTENCE_BREAK_RE.split(att_paragraph)
+    sentence_matcher = ReportMatcher(res_sentences, att_sentences)
+    for opcode, a1, a2, b1, b2 in sentence_matcher.get_opcodes():
+        res_words = " ".join(res_sentences[a1:a2]).split()
+        if opcode == 'equal':
+            diff_parts.extend((" ".join(res_words), " "))
+        else:
+            append_word_diff(diff_parts, res_words, " ".join(att_sentences[b1:b2]).split())
+
+# Stable key for OpenAI's server-side prompt cache, computed once per distinct prompt
+@lru_cache(maxsize=32)
+def prompt_cache_key(custom_prompt):
+    return hashlib.sha256(f"{MODEL_ID}\0{custom_prompt}".encode()).hexdigest()[:32]
+
+# Chat completion parameters for one case on the interactive path
+# The static prompt leads the messages so every case in a submission shares the cached prefix
+def build_chat_request(case_text, custom_prompt, case_number):
+    return {
+        "model": MODEL_ID,
+        "messages": [
+            {"role": "system", "content": "You are a helpful assistant that outputs structured JSON summaries of radiology report differences."},
+            {"role": "user", "content": f"{custom_prompt}\nCase Number: {case_number}\n{case_text}"}
+        ],
+        "max_tokens": 2000,
+        "temperature": 0.5,
+        # JSON mode: the reply is always a parseable object, so a call is never wasted on malformed output
+        "response_format": {"type": "json_object"},
+        # Sent as a raw body field: SDK releases that predate the keyword would raise TypeError on it
+        "extra_body": {"prompt_cache_key": prompt_cache_key(custom_prompt)}
+    }
+
+# Cases packed into each Batch API request, so the prompt is sent once per group rather than once per case
+CASES_PER_BATCH_REQUEST = 10
+
+MULTI_CASE_INSTRUCTIONS = (
+    "Several cases follow, separated by lines of ---. Summarize each case separately in the format above, "
+    'and respond with a single JSON object {"results": [...]} holding one summary per case, in the order given.'
+)
+
+# Chat completion parameters summarizing several (case_number, case_text) cases in one request;
+# the reply is a {"results": [...]} object with one summary per case
+def build_multi_case_request(cases, custom_prompt):
+    cases_text = "\n---\n".join(f"Case Number: {case_number}\n{case_text}" for case_number, case_text in cases)
+    return {
+        "model": MODEL_ID,
+        "messages": [
+            {"role": "system", "content": "You are a helpful assistant that outputs structured JSON summaries of radiology report differences."},
+            {"role": "user", "content": f"{custom_prompt}\n{MULTI_CASE_INSTRUCTIONS}\n{cases_text}"}
+        ],
+        "max_tokens": min(16000, 2000 * len(cases)),
+        "temperature": 0.5,
+        "response_format": {"type": "json_object"},
+        "prompt_cache_key": prompt_cache_key(custom_prompt)
+    }
+
+# Match the summaries of a multi-case reply to its case numbers; cases with no summary get None
+# Position is only trusted when no summary echoes a case number: once any does, a skipped case would
+# shift a neighbour's findings onto it, so matching is by number alone and each summary is used once
+def split_multi_case_results(case_numbers, parsed_json):
+    results = parsed_json.get("results") if isinstance(parsed_json, dict) else None
+    if not isinstance(results, list):
+        return [None] * len(case_numbers)
+    results = [result for result in results if isinstance(result, dict)]
+    if all(result.get("case_number") is None for result in results):
+        return [results[position] if position < len(results) else None for position in range(len(case_numbers))]
+    by_number = {}
+    for result in results:
+        by_number.setdefault(str(result.get("case_number")), []).append(result)
+    return [by_number[case_number].pop(0) if by_number.get(case_number) else None for case_number in case_numbers]
 
 # AI function to get a structured JSON summary of report differences
-def get_summary(case_text, custom_prompt, case_number):
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant that outputs structured JSON summaries of radiology report differences."},
-                {"role": "user", "content": f"{custom_prompt}\nCase Number: {case_number}\n{case_text}"}
-            ],
-            max_tokens=2000,
-            temperature=0.5
-        )
-        response_content = response.choices[0].message.content
-        return json.loads(response_content)
-    except Exception as e:
-        return {"case_number": case_number, "error": "Error processing AI"}
-
-# Process cases for summaries
-def process_cases(bulk_text, custom_prompt):
-    case_numbers = re.findall(r"Case (\d+)", bulk_text)
-    cases = bulk_text.split("Case")
-    structured_output = []
-    for index, case in enumerate(cases[1:], start=1):
-        if "Attending Report" in case and "Resident Report" in case:
-            case_number = case_numbers[index - 1] if index - 1 < len(case_numbers) else index
-            attending_report = case.split("Attending Report:")[1].split("Resident Report:")[0].strip()
-            resident_report = case.split("Resident Report:")[1].strip()
-            case_text = f"Resident Report: {resident_report}\nAttending Report: {attending_report}"
-            parsed_json = get_summary(case_text, custom_prompt, case_number=case_number) or {}
-            parsed_json['score'] = len(parsed_json.get('major_findings', [])) * 3 + len(parsed_json.get('minor_findings', []))
-            structured_output.append(parsed_json)
-    return structured_output
-
-# Extract cases and add AI summary tab
-def extract_cases(text, custom_prompt):
-    cases = re.split(r'\bCase\s+(\d+)', text, flags=re.IGNORECASE)
+# When on_delta is given the completion is streamed and each content delta is passed to it as it arrives
+async def get_summary(aclient, case_text, custom_prompt, case_number, on_delta=None):
+    # Repeated (prompt, case) pairs skip the network entirely
+    cache_key = summary_cache_key(case_text, custom_prompt)
+    cached_content = get_cached_summary(cache_key)
+    if cached_content is not None:
+        parsed_json = orjson.loads(cached_content)
+        # Entries stored before replies were validated may be malformed; those are requested again
+        if is_valid_summary(parsed_json):
+            parsed_json['case_number'] = case_number
+            return parsed_json
+
+    # Rough token estimate (~4 characters per token) plus the completion budget
+    estimated_tokens = (len(custom_prompt) + len(case_text)) // 4 + 2000
+    for attempt in range(MAX_ATTEMPTS):
+        await rate_limiter.acquire(estimated_tokens)
+        try:
+            response = await aclient.chat.completions.create(
+                **build_chat_request(case_text, custom_prompt, case_number),
+                stream=on_delta is not None
+            )
+            if on_delta is None:
+                response_content = response.choices[0].message.content
+            else:
+                parts = []
+                tracker = JSONObjectTracker()
+                async for chunk in response:
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        # Stop decoding once the JSON object is complete instead of waiting for trailing tokens
+                        end = tracker.feed(delta)
+                        if end != -1:
+                            delta = delta[:end]
+                        parts.append(delta)
+                        on_delta(delta)
+                        if end != -1:
+                            break
+                await response.close()
+                response_content = "".join(parts)
+            parsed_json = orjson.loads(response_content)
+            # Only cache what finalize_summary will accept, or a malformed reply is replayed on every resubmission
+            if is_valid_summary(parsed_json):
+                cache_summary(cache_key, response_content)
+            return parsed_json
+        except (RateLimitError, APIConnectionError) as e:
+            # Back off exponentially and retry transient failures
+            logger.warning("Case %s: %s on attempt %d/%d", case_number, type(e).__name__, attempt + 1, MAX_ATTEMPTS)
+            if attempt + 1 < MAX_ATTEMPTS:
+                await asyncio.sleep(min(60, 2 ** attempt))
+        except Exception:
+            logger.exception("Case %s: summary failed", case_number)
+            break
+    return {"case_number": case_number, "error": "Error processing AI"}
+
+# Summary fields the page renders as lists
+SUMMARY_LIST_FIELDS = ("major_findings", "minor_findings", "clarifications")
+
+# Whether a parsed reply can be shown and scored: a non-empty object whose list fields are lists
+# (null or absent counts as empty)
+def is_valid_summary(parsed_json):
+    return (
+        isinstance(parsed_json, dict) and len(parsed_json) > 0
+        and all(isinstance(parsed_json.get(field) or [], list) for field in SUMMARY_LIST_FIELDS)
+    )
+
+# Fill in the error summary for a failed call or a malformed reply, and score it:
+# 3 points per major finding, 1 per minor finding
+def finalize_summary(case_number, parsed_json):
+    if not is_valid_summary(parsed_json):
+        parsed_json = {"case_number": case_number, "error": "Error processing AI"}
+    parsed_json['score'] = len(parsed_json.get('major_findings') or []) * 3 + len(parsed_json.get('minor_findings') or [])
+    return parsed_json
+
+# Summary for a case whose reports have the same words: there is nothing the resident could have missed
+def unchanged_summary(case_number):
+    return {"case_number": case_number, "major_findings": [], "minor_findings": [], "clarifications": [], "score": 0}
+
+# Run get_summary for every case concurrently, capped by MAX_CONCURRENT_REQUESTS
+# on_delta(case_number, delta) streams tokens; on_summary(case_number, summary) fires as each case finishes
+async def gather_summaries(cases, custom_prompt, on_delta=None, on_summary=None):
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    async with create_async_client() as aclient:
+        async def summarize(case_number, case_text):
+            case_delta = (lambda delta: on_delta(case_number, delta)) if on_delta else None
+            try:
+                async with semaphore:
+                    summary = finalize_summary(case_number, await get_summary(aclient, case_text, custom_prompt, case_number, case_delta))
+            except Exception:
+                # Still deliver a summary, so the page shows the failure instead of a card with no result
+                logger.exception("Case %s: summary failed", case_number)
+                summary = finalize_summary(case_number, None)
+            if on_summary:
+                on_summary(case_number, summary)
+            return summary
+        return await asyncio.gather(*(summarize(case_number, case_text) for case_number, case_text in cases), return_exceptions=True)
+
+# Summarize cases on a background event loop; returns an iterator of (event, data) tuples
+# that yields "delta" events as tokens arrive (if stream_tokens) and a "summary" event as each case completes
+def stream_summaries(cases, custom_prompt, stream_tokens=True):
+    events = queue.Queue()
+
+    def run():
+        try:
+            asyncio.run(gather_summaries(
+                cases, custom_prompt,
+                on_delta=(lambda case_number, delta: events.put(("delta", {"case_num": case_number, "delta": delta}))) if stream_tokens else None,
+                on_summary=lambda case_number, summary: events.put(("summary", {"case_num": case_number, "summary": summary}))
+            ))
+        finally:
+            events.put(None)
+
+    threading.Thread(target=run, daemon=True).start()
+    return drain_events(events)
+
+# Yield queued events until the None sentinel, plus a "keepalive" event whenever
+# KEEPALIVE_INTERVAL seconds pass with nothing to send, so proxies neither time out nor buffer
+def drain_events(events):
+    while True:
+        try:
+            event = events.get(timeout=KEEPALIVE_INTERVAL)
+        except queue.Empty:
+            yield "keepalive", None
+            continue
+        if event is None:
+            return
+        yield event
+
+# Split a pasted block into cases with their attending and resident reports
+# Works on offsets into the original text: one scan for case headers, and a bounded scan
+# for the first report labels inside each case, without building intermediate split lists
+def parse_cases(text):
+    # Browsers submit textarea line breaks as CRLF; fold them in one native pass so reports,
+    # diffs and prompts all carry plain newlines
+    text = text.replace("\r\n", "\n")
+    case_matches = list(CASE_RE.finditer(text))
     parsed_cases = []
-    for i in range(1, len(cases), 2):
-        case_num = cases[i]
-        case_content = cases[i + 1].strip()
-        reports = re.split(r'\s*(Attending\s+Report\s*:|Resident\s+Report\s*:)\s*', case_content, flags=re.IGNORECASE)
-        if len(reports) >= 3:
-            attending_report = reports[2].strip()
-            resident_report = reports[4].strip() if len(reports) > 4 else ""
-            ai_summary = process_cases(f"Case {case_num}\n{case_content}", custom_prompt)
+    for i, case_match in enumerate(case_matches):
+        case_end = case_matches[i + 1].start() if i + 1 < len(case_matches) else len(text)
+        # The report following the first label is the attending's, the one after the second the resident's
+        labels = list(islice(REPORT_LABEL_RE.finditer(text, case_match.end(), case_end), 3))
+        if labels:
+            attending_end = labels[1].start() if len(labels) > 1 else case_end
+            resident_end = labels[2].start() if len(labels) > 2 else case_end
             parsed_cases.append({
-                'case_num': case_num,
-                'resident_report': resident_report,
-                'attending_report': attending_report,
-                'percentage_change': calculate_change_percentage(resident_report, remove_attending_review_line(attending_report)),
-                'diff': create_diff_by_section(resident_report, attending_report),
-                'summary': ai_summary[0] if ai_summary else None
+                'case_num': case_match.group(1),
+                'resident_report': text[labels[1].end():resident_end].strip() if len(labels) > 1 else "",
+                'attending_report': text[labels[0].end():attending_end].strip(),
+                'summary': None
             })
     return parsed_cases
 
+# Build the (case_number, case_text) summary requests for cases that have both reports and no summary yet
+def build_summary_requests(parsed_cases):
+    return [
+        (case['case_num'], f"Resident Report: {case['resident_report']}\nAttending Report: {case['attending_report']}")
+        for case in parsed_cases if case['attending_report'] and case['resident_report'] and case['summary'] is None
+    ]
+
+# Add the change percentage to a parsed case; its diff is only computed when the page asks /diff for it
+# Splitting gives the same words tokenize_report would: paragraph breaks are whitespace, and split()
+# already ignores the whitespace normalize_text folds, so only the attending lines need cleaning
+def add_comparison(case):
+    resident_words = case['resident_report'].split()
+    attending_words = clean_attending(case['attending_report']).split()
+    case['percentage_change'] = calculate_change_percentage(resident_words, attending_words)
+    # Reports signed without edits get their (empty) summary here instead of an OpenAI call
+    if resident_words and resident_words == attending_words:
+        case['summary'] = unchanged_summary(case['case_num'])
+    return case
+
+# Yield (event, data) tuples for a submission: every case with its change percentage first,
+# then summary deltas (when stream_tokens is set) and results as each case completes
+# summarize=False yields only the cases, for submissions whose summaries go through the Batch API
+def iter_case_events(text, custom_prompt, stream_tokens=True, summarize=True):
+    parsed_cases = [add_comparison(case) for case in parse_cases(text)]
+    summary_events = stream_summaries(build_summary_requests(parsed_cases), custom_prompt, stream_tokens) if summarize else ()
+    for case in parsed_cases:
+        yield "case", case
+    yield from summary_events
+    yield "done", {}
+
+# Format one server-sent event frame
+def format_sse(event, data):
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+# Stream cases as server-sent events: every case first, then summary tokens and results as they arrive
+@app.route('/stream', methods=['POST'])
+def stream():
+    custom_prompt = get_custom_prompt()
+    # In batch mode the page submits the summaries to /submit_batch and only needs the cases here
+    events = iter_case_events(request.form['report_text'], custom_prompt, summarize='batch_mode' not in request.form)
+
+    def generate():
+        for event, data in events:
+            # SSE comment lines keep the connection visibly alive without reaching the client's handler
+            yield ": keepalive\n\n" if event == "keepalive" else format_sse(event, data)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=STREAM_HEADERS)
+
+# Submit every case to the Batch API (half price, completes within 24h) instead of the interactive path
+@app.route('/submit_batch', methods=['POST'])
+def submit_batch():
+    custom_prompt = get_custom_prompt()
+    summary_requests = build_summary_requests([add_comparison(case) for case in parse_cases(request.form['report_text'])])
+    if not summary_requests:
+        return {"error": "No cases with differing attending and resident reports were found"}, 400
+
+    # Each line summarizes up to CASES_PER_BATCH_REQUEST cases; custom_id carries the group position
+    # and its comma-separated case numbers so results can be put back in order
+    groups = [summary_requests[i:i + CASES_PER_BATCH_REQUEST] for i in range(0, len(summary_requests), CASES_PER_BATCH_REQUEST)]
+    lines = [
+        orjson.dumps({
+            "custom_id": f"{index}:{','.join(case_number for case_number, _ in group)}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": build_multi_case_request(group, custom_prompt)
+        })
+        for index, group in enumerate(groups)
+    ]
+    try:
+        input_file = client.files.create(file=("cases.jsonl", b"\n".join(lines)), purpose="batch")
+        batch = client.batches.create(input_file_id=input_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+    except APIError as e:
+        logger.exception("Batch submission failed")
+        return {"error": f"Batch submission failed: {e.message}"}, 502
+    logger.info("Submitted batch %s with %d cases", batch.id, len(summary_requests))
+    return {"batch_id": batch.id, "status": batch.status}
+
+# Report a batch's status and, once it has completed, its summaries in submission order
+@app.route('/poll_batch/<batch_id>')
+def poll_batch(batch_id):
+    batch = client.batches.retrieve(batch_id)
+    if batch.status != "completed":
+        return {"batch_id": batch.id, "status": batch.status}
+
+    results = {}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        for line in client.files.content(file_id).text.splitlines():
+            if not line.strip():
+                continue
+            result = orjson.loads(line)
+            index, case_numbers = result["custom_id"].split(":", 1)
+            case_numbers = case_numbers.split(",")
+            parsed_json = None
+            response = result.get("response") or {}
+            if response.get("status_code") == 200:
+                try:
+                    parsed_json = orjson.loads(response["body"]["choices"][0]["message"]["content"])
+                except (KeyError, IndexError, TypeError, ValueError):
+                    parsed_json = None
+            results[int(index)] = [
+                {"case_num": case_number, "summary": finalize_summary(case_number, summary)}
+                for case_number, summary in zip(case_numbers, split_multi_case_results(case_numbers, parsed_json))
+            ]
+    return {"batch_id": batch.id, "status": batch.status, "summaries": [summary for index in sorted(results) for summary in results[index]]}
+
+# Combined diff of one case's reports, fetched by the page the first time that case's diff tab is opened
+@app.route('/diff', methods=['POST'])
+def diff():
+    return create_diff_by_section(request.form['resident_report'], request.form['attending_report'])
+
+# Render a template as a stream of chunks so the browser can draw each case as soon as it is emitted
+def stream_template(template_name, **context):
+    app.update_template_context(context)
+    return app.jinja_env.get_template(template_name).generate(context)
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
-    custom_prompt = request.form.get('custom_prompt', DEFAULT_PROMPT)
-    case_data = []
+    custom_prompt = get_custom_prompt()
+    events = []
 
     if request.method == 'POST':
         text_block = request.form['report_text']
-        case_data = extract_cases(text_block, custom_prompt)
-
-    template = """
-<html>
-    <head>
-        <title>Radiology Report Diff & Summarizer</title>
-        <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/css/bootstrap.min.css">
-        <style>
-                body { background-color: #1e1e1e; color: #dcdcdc; font-family: Arial, sans-serif; }
-                textarea, input, button { background-color: #333333; color: #dcdcdc; border: 1px solid #555; }
-                textarea { background-color: #333333 !important; color: #dcdcdc !important; border: 1px solid #555 !important; }
-                h2, h3, h4 { color: #f0f0f0; font-weight: normal; }
-                .diff-output, .summary-output { margin-top: 20px; padding: 15px; background-color: #2e2e2e; border-radius: 8px; border: 1px solid #555; }
-                pre { white-space: pre-wrap; word-wrap: break-word; font-family: inherit; }
-                .nav-tabs .nav-link { background-color: #333; border-color: #555; color: #dcdcdc; }
-                .nav-tabs .nav-link.active { background-color: #007bff; border-color: #007bff #007bff #333; color: white; }
-
-                /* Scroll-to-top button */
-                #scrollToTopBtn {
-                        position: fixed;
-                        right: 20px;
-                        bottom: 20px;
-                        background-color: #007bff;
-                        color: white;
-                        padding: 10px 15px;
-                        border-radius: 15px;
-                        border: none;
-                        cursor: pointer;
-                        z-index: 1000;
-                }
-                #scrollToTopBtn:hover {
-                        background-color: #0056b3;
-                }
-
-                /* Links styling for night mode */
-                a {
-                        color: #66ccff; /* A softer blue that is easier on the eyes in night mode */
-                        text-decoration: none; /* Removes underline */
-                }
-                a:hover {
-                        color: #99e6ff; /* A lighter blue for hover state */
-                        text-decoration: none; /* Ensures no underline on hover */
-                }
-        </style>
-
-    </head>
-    <body>
-        <div class="container">
-            <h2 class="mt-4">Compare Revisions & Summarize Reports</h2>
-            <form method="POST" id="reportForm">
-                <div class="form-group mb-3">
-                    <label for="report_text">Paste your reports block here:</label>
-                    <textarea id="report_text" name="report_text" class="form-control" rows="10">{{ request.form.get('report_text', '') }}</textarea>
-                </div>
-                <div class="form-group mb-3">
-                    <label for="custom_prompt">Customize your OpenAI API prompt:</label>
-                    <textarea id="custom_prompt" name="custom_prompt" class="form-control" rows="5">{{ custom_prompt }}</textarea>
-                </div>
-                <button type="submit" class="btn btn-primary">Compare & Summarize Reports</button>
-            </form>
-            {% if case_data %}
-                <h3 id="majorFindings">Major Findings Missed</h3>
-                <ul>
-                    {% for case in case_data %}
-                        {% if case.summary and case.summary.major_findings %}
-                            {% for finding in case.summary.major_findings %}
-                                <li><a href="#case{{ case.case_num }}">Case {{ case.case_num }}</a>: {{ finding }}</li>
-                            {% endfor %}
-                        {% endif %}
-                    {% endfor %}
-                </ul>
-                <h3>Minor Findings Missed</h3>
-                <ul>
-                    {% for case in case_data %}
-                        {% if case.summary and case.summary.minor_findings %}
-                            {% for finding in case.summary.minor_findings %}
-                                <li><a href="#case{{ case.case_num }}">Case {{ case.case_num }}</a>: {{ finding }}</li>
-                            {% endfor %}
-                        {% endif %}
-                    {% endfor %}
-                </ul>
-                <h3>Case Navigation</h3>
-                <div class="btn-group" role="group" aria-label="Sort Options">
-                    <button type="button" class="btn btn-secondary" onclick="sortCases('case_number')">Sort by Case Number</button>
-                    <button type="button" class="btn btn-secondary" onclick="sortCases('percentage_change')">Sort by Percentage Change</button>
-                    <button type="button" class="btn btn-secondary" onclick="sortCases('summary_score')">Sort by Summary Score</button>
-                </div>
-                <ul id="caseNav"></ul>
-                <div id="caseContainer"></div>
-            {% endif %}
-        </div>
-        <!-- Added scroll-to-top button -->
-        <button id="scrollToTopBtn" onclick="scrollToTop()">Top ⬆</button>
-        <script>
-            let caseData = {{ case_data | tojson }};
-            
-            function sortCases(option) {
-                if (option === "case_number") {
-                    caseData.sort((a, b) => parseInt(a.case_num) - parseInt(b.case_num));
-                } else if (option === "percentage_change") {
-                    caseData.sort((a, b) => b.percentage_change - a.percentage_change);
-                } else if (option === "summary_score") {
-                    caseData.sort((a, b) => (b.summary && b.summary.score || 0) - (a.summary && a.summary.score || 0));
-                }
-                displayCases();
-                displayNavigation();
-            }
-            function displayNavigation() {
-                const nav = document.getElementById('caseNav');
-                nav.innerHTML = '';
-                caseData.forEach(caseObj => {
-                    nav.innerHTML += `
-                        <li>
-                            <a href="#case${caseObj.case_num}">Case ${caseObj.case_num}</a> - ${caseObj.percentage_change}% change - Score: ${(caseObj.summary && caseObj.summary.score) || 'N/A'}
-                        </li>
-                    `;
-                });
-            }
-            function displayCases() {
-                const container = document.getElementById('caseContainer');
-                container.innerHTML = '';
-                caseData.forEach(caseObj => {
-                    container.innerHTML += `
-                        <div id="case${caseObj.case_num}">
-                            <h4>Case ${caseObj.case_num} - ${caseObj.percentage_change}% change</h4>
-                            <ul class="nav nav-tabs" id="myTab${caseObj.case_num}" role="tablist">
-                                <li class="nav-item" role="presentation">
-                                    <button class="nav-link active" id="summary-tab${caseObj.case_num}" data-bs-toggle="tab" data-bs-target="#summary${caseObj.case_num}" type="button" role="tab">Summary Report</button>
-                                </li>
-                                <li class="nav-item" role="presentation">
-                                    <button class="nav-link" id="combined-tab${caseObj.case_num}" data-bs-toggle="tab" data-bs-target="#combined${caseObj.case_num}" type="button" role="tab">Combined Report</button>
-                                </li>
-                                <li class="nav-item" role="presentation">
-                                    <button class="nav-link" id="resident-tab${caseObj.case_num}" data-bs-toggle="tab" data-bs-target="#resident${caseObj.case_num}" type="button" role="tab">Resident Report</button>
-                                </li>
-                                <li class="nav-item" role="presentation">
-                                    <button class="nav-link" id="attending-tab${caseObj.case_num}" data-bs-toggle="tab" data-bs-target="#attending${caseObj.case_num}" type="button" role="tab">Attending Report</button>
-                                </li>
-                            </ul>
-                            <div class="tab-content" id="myTabContent${caseObj.case_num}">
-                                <div class="tab-pane fade show active" id="summary${caseObj.case_num}" role="tabpanel">
-                                    <div class="summary-output">
-                                        <p><strong>Score:</strong> ${caseObj.summary && caseObj.summary.score || 'N/A'}</p>
-                                        ${caseObj.summary && caseObj.summary.major_findings?.length ? `<p><strong>Major Findings:</strong></p><ul>${caseObj.summary.major_findings.map(finding => `<li>${finding}</li>`).join('')}</ul>` : ''}
-                                        ${caseObj.summary && caseObj.summary.minor_findings?.length ? `<p><strong>Minor Findings:</strong></p><ul>${caseObj.summary.minor_findings.map(finding => `<li>${finding}</li>`).join('')}</ul>` : ''}
-                                        ${caseObj.summary && caseObj.summary.clarifications?.length ? `<p><strong>Clarifications:</strong></p><ul>${caseObj.summary.clarifications.map(clarification => `<li>${clarification}</li>`).join('')}</ul>` : ''}
-                                    </div>
-                                </div>
-                                <div class="tab-pane fade" id="combined${caseObj.case_num}" role="tabpanel">
-                                    <div class="diff-output">${caseObj.diff}</div>
-                                </div>
-                                <div class="tab-pane fade" id="resident${caseObj.case_num}" role="tabpanel">
-                                    <div class="diff-output"><pre>${caseObj.resident_report}</pre></div>
-                                </div>
-                                <div class="tab-pane fade" id="attending${caseObj.case_num}" role="tabpanel">
-                                    <div class="diff-output"><pre>${caseObj.attending_report}</pre></div>
-                                </div>
-                            </div>
-                            <hr>
-                        </div>
-                    `;
-                });
-            }
-            document.addEventListener("DOMContentLoaded", () => {
-                displayCases();
-                displayNavigation();
-            });
-            // Added scrollToTop function
-            function scrollToTop() {
-                const majorFindingsSection = document.getElementById('majorFindings');
-                if (majorFindingsSection) {
-                    majorFindingsSection.scrollIntoView({ behavior: 'smooth' });
-                }
-            }
-        </script>
-        <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/js/bootstrap.bundle.min.js"></script>
-    </body>
-</html>
-    """
-    return render_template_string(template, case_data=case_data, custom_prompt=custom_prompt)
+        events = iter_case_events(text_block, custom_prompt, stream_tokens=False)
+
+    return Response(stream_with_context(stream_template('index.html', events=events, custom_prompt=custom_prompt)), headers=STREAM_HEADERS)
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,18 @@
+# Production server settings, picked up automatically by `gunicorn app:app`
+import multiprocessing
+import os
+
+# Requests spend nearly all their time waiting on the OpenAI API (and /stream holds its connection
+# open for the whole run), so each process serves many of them on threads instead of blocking one
+# worker per request
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = 16
+
+# Each worker throttles its own OpenAI calls; exporting the worker count lets app.py give each one
+# its share of OPENAI_MAX_RPM / OPENAI_MAX_TPM rather than the whole account's limits
+raw_env = [f"WEB_CONCURRENCY={workers}"]
+
+# Streamed responses can run for minutes; gthread workers heartbeat from their main loop, so this
+# only bounds a worker that has genuinely hung
+timeout = 120
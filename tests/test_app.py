@@ -0,0 +1,64 @@
+import os
+import sys
+import unittest
+
+# app builds its OpenAI client at import, which needs a key even though these tests never call the API
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("SUMMARY_CACHE_PATH", "")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+class SplitMultiCaseResultsTest(unittest.TestCase):
+    def test_matches_echoed_case_numbers(self):
+        results = [{"case_number": "6", "score": 1}, {"case_number": 5, "score": 2}]
+        self.assertEqual(
+            app.split_multi_case_results(["5", "6"], {"results": results}),
+            [results[1], results[0]]
+        )
+
+    def test_skipped_case_gets_no_other_cases_summary(self):
+        results = [{"case_number": 5}, {"case_number": 7}]
+        self.assertEqual(
+            app.split_multi_case_results(["5", "6", "7"], {"results": results}),
+            [results[0], None, results[1]]
+        )
+
+    def test_falls_back_to_position_without_case_numbers(self):
+        results = [{"score": 1}, {"score": 2}]
+        self.assertEqual(
+            app.split_multi_case_results(["5", "6", "7"], {"results": results}),
+            [results[0], results[1], None]
+        )
+
+    def test_malformed_reply(self):
+        self.assertEqual(app.split_multi_case_results(["5", "6"], {"summary": []}), [None, None])
+        self.assertEqual(app.split_multi_case_results(["5"], None), [None])
+
+
+class FinalizeSummaryTest(unittest.TestCase):
+    def test_scores_findings(self):
+        summary = app.finalize_summary("5", {"case_number": "5", "major_findings": ["a"], "minor_findings": ["b", "c"], "clarifications": None})
+        self.assertEqual(summary["score"], 5)
+
+    def test_malformed_findings_become_error_summary(self):
+        summary = app.finalize_summary("5", {"case_number": "5", "major_findings": "none", "minor_findings": []})
+        self.assertEqual(summary, {"case_number": "5", "error": "Error processing AI", "score": 0})
+
+    def test_one_malformed_case_leaves_the_rest_of_a_batch_reply(self):
+        results = [{"case_number": 5, "major_findings": ["a"]}, {"case_number": 6, "major_findings": 3}]
+        summaries = [
+            app.finalize_summary(case_number, summary)
+            for case_number, summary in zip(["5", "6"], app.split_multi_case_results(["5", "6"], {"results": results}))
+        ]
+        self.assertEqual([summary["score"] for summary in summaries], [3, 0])
+        self.assertIn("error", summaries[1])
+
+    def test_failed_call(self):
+        self.assertIn("error", app.finalize_summary("5", RuntimeError("boom")))
+        self.assertIn("error", app.finalize_summary("5", None))
+
+
+if __name__ == '__main__':
+    unittest.main()